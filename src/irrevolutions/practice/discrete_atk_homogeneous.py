@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
-from irrevolutions.utils import ColorPrint, norm_H1, norm_L2
+from irrevolutions.utils import ColorPrint
+from irrevolutions.utils.homogeneous import fill_homogeneous
 from utils.viz import plot_matrix
 from utils.plots import plot_energies
-from solvers import SNESSolver
 from algorithms.so import BifurcationSolver, StabilitySolver
+import copy
+import functools
 import json
 import logging
 import os
 import sys
+from contextlib import nullcontext
 from pathlib import Path
 
 import dolfinx
 import dolfinx.mesh
 import dolfinx.plot
+import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import petsc4py
@@ -20,8 +24,7 @@ import ufl
 import yaml
 from dolfinx.common import list_timings
 from dolfinx.fem import (Constant, Function, assemble_scalar, dirichletbc,
-                         form, locate_dofs_geometrical, set_bc)
-from dolfinx.fem.petsc import assemble_vector
+                         form)
 from dolfinx.io import XDMFFile
 from mpi4py import MPI
 from petsc4py import PETSc
@@ -46,167 +49,22 @@ logging.getLogger().setLevel(logging.CRITICAL)
 comm = MPI.COMM_WORLD
 
 
-class _AlternateMinimisation:
-    def __init__(
-        self,
-        total_energy,
-        state,
-        bcs,
-        solver_parameters={},
-        bounds=(dolfinx.fem.function.Function, dolfinx.fem.function.Function),
-    ):
-        self.state = state
-        self.alpha = state["alpha"]
-        self.alpha_old = dolfinx.fem.function.Function(self.alpha.function_space)
-        self.u = state["u"]
-        self.alpha_lb = bounds[0]
-        self.alpha_ub = bounds[1]
-        self.total_energy = total_energy
-        self.solver_parameters = solver_parameters
-
-        V_u = state["u"].function_space
-        V_alpha = state["alpha"].function_space
-
-        energy_u = ufl.derivative(self.total_energy, self.u, ufl.TestFunction(V_u))
-        energy_alpha = ufl.derivative(
-            self.total_energy, self.alpha, ufl.TestFunction(V_alpha)
-        )
-
-        self.F = [energy_u, energy_alpha]
-
-        self.elasticity = SNESSolver(
-            energy_u,
-            self.u,
-            bcs.get("bcs_u"),
-            bounds=None,
-            petsc_options=self.solver_parameters.get("elasticity").get("snes"),
-            prefix=self.solver_parameters.get("elasticity").get("prefix"),
-        )
-
-        self.damage = SNESSolver(
-            energy_alpha,
-            self.alpha,
-            bcs.get("bcs_alpha"),
-            bounds=(self.alpha_lb, self.alpha_ub),
-            petsc_options=self.solver_parameters.get("damage").get("snes"),
-            prefix=self.solver_parameters.get("damage").get("prefix"),
-        )
-
-    def solve(self, outdir=None):
-        alpha_diff = dolfinx.fem.Function(self.alpha.function_space)
-
-        self.data = {
-            "iteration": [],
-            "error_alpha_L2": [],
-            "error_alpha_H1": [],
-            "F_norm": [],
-            "error_alpha_max": [],
-            "error_residual_F": [],
-            "solver_alpha_reason": [],
-            "solver_alpha_it": [],
-            "solver_u_reason": [],
-            "solver_u_it": [],
-            "total_energy": [],
-        }
-        for iteration in range(
-            self.solver_parameters.get("damage_elasticity").get("max_it")
-        ):
-            with dolfinx.common.Timer("~Alternate Minimization : Elastic solver"):
-                (solver_u_it, solver_u_reason) = self.elasticity.solve()
-            with dolfinx.common.Timer("~Alternate Minimization : Damage solver"):
-                (solver_alpha_it, solver_alpha_reason) = self.damage.solve()
-
-            # Define error function
-            self.alpha.x.petsc_vec.copy(alpha_diff.x.petsc_vec)
-            alpha_diff.x.petsc_vec.axpy(-1, self.alpha_old.x.petsc_vec)
-            alpha_diff.x.petsc_vec.ghostUpdate(
-                addv=PETSc.InsertMode.INSERT, mode=PETSc.ScatterMode.FORWARD
-            )
-
-            error_alpha_H1 = norm_H1(alpha_diff)
-            error_alpha_L2 = norm_L2(alpha_diff)
-
-            Fv = [assemble_vector(form(F)) for F in self.F]
-
-            Fnorm = np.sqrt(
-                np.array([comm.allreduce(Fvi.norm(), op=MPI.SUM) for Fvi in Fv]).sum()
-            )
-
-            error_alpha_max = alpha_diff.x.petsc_vec.max()[1]
-            total_energy_int = comm.allreduce(
-                assemble_scalar(form(self.total_energy)), op=MPI.SUM
-            )
-            residual_F = assemble_vector(self.elasticity.F_form)
-            residual_F.ghostUpdate(
-                addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE
-            )
-            set_bc(residual_F, self.elasticity.bcs, self.u.x.petsc_vec)
-            error_residual_F = ufl.sqrt(residual_F.dot(residual_F))
-
-            self.alpha.x.petsc_vec.copy(self.alpha_old.x.petsc_vec)
-            self.alpha_old.x.petsc_vec.ghostUpdate(
-                addv=PETSc.InsertMode.INSERT, mode=PETSc.ScatterMode.FORWARD
-            )
-
-            logging.critical(
-                f"AM - Iteration: {iteration:3d}, res F Error: {error_residual_F:3.4e}, alpha_max: {self.alpha.x.petsc_vec.max()[1]:3.4e}"
-            )
-
-            logging.critical(
-                f"AM - Iteration: {iteration:3d}, H1 Error: {error_alpha_H1:3.4e}, alpha_max: {self.alpha.x.petsc_vec.max()[1]:3.4e}"
-            )
-
-            logging.critical(
-                f"AM - Iteration: {iteration:3d}, L2 Error: {error_alpha_L2:3.4e}, alpha_max: {self.alpha.x.petsc_vec.max()[1]:3.4e}"
-            )
-
-            logging.critical(
-                f"AM - Iteration: {iteration:3d}, Linfty Error: {error_alpha_max:3.4e}, alpha_max: {self.alpha.x.petsc_vec.max()[1]:3.4e}"
-            )
-
-            self.data["iteration"].append(iteration)
-            self.data["error_alpha_L2"].append(error_alpha_L2)
-            self.data["error_alpha_H1"].append(error_alpha_H1)
-            self.data["F_norm"].append(Fnorm)
-            self.data["error_alpha_max"].append(error_alpha_max)
-            self.data["error_residual_F"].append(error_residual_F)
-            self.data["solver_alpha_it"].append(solver_alpha_it)
-            self.data["solver_alpha_reason"].append(solver_alpha_reason)
-            self.data["solver_u_reason"].append(solver_u_reason)
-            self.data["solver_u_it"].append(solver_u_it)
-            self.data["total_energy"].append(total_energy_int)
-
-            if (
-                self.solver_parameters.get("damage_elasticity").get("criterion")
-                == "residual_u"
-            ):
-                if error_residual_F <= self.solver_parameters.get(
-                    "damage_elasticity"
-                ).get("alpha_rtol"):
-                    break
-            if (
-                self.solver_parameters.get("damage_elasticity").get("criterion")
-                == "alpha_H1"
-            ):
-                if error_alpha_H1 <= self.solver_parameters.get(
-                    "damage_elasticity"
-                ).get("alpha_rtol"):
-                    break
-        else:
-            raise RuntimeError(
-                f"Could not converge after {iteration:3d} iterations, error {error_alpha_H1:3.4e}"
-            )
+petsc4py.init(sys.argv)
 
 
-petsc4py.init(sys.argv)
+@functools.lru_cache(maxsize=1)
+def _load_parameters(path, mtime):
+    """Parse the parameter file, cached on its path and modification time"""
+    with open(path) as f:
+        return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
 
 def discrete_atk(arg_N=2):
     # Mesh on node model_rank and then distribute
     pass
 
-    with open("./parameters.yml") as f:
-        parameters = yaml.load(f, Loader=yaml.FullLoader)
+    _path = os.path.abspath("./parameters.yml")
+    parameters = copy.deepcopy(_load_parameters(_path, os.path.getmtime(_path)))
 
     # parameters["stability"]["cone"] = ""
     # parameters["cone"]["atol"] = 1e-7
@@ -264,11 +122,6 @@ def discrete_atk(arg_N=2):
         with open(f"{prefix}/signature.md5", "w") as f:
             f.write(signature)
 
-    with XDMFFile(
-        comm, f"{prefix}/{_nameExp}.xdmf", "w", encoding=XDMFFile.Encoding.HDF5
-    ) as file:
-        file.write_mesh(mesh)
-
     # Functional Setting
 
     element_u = basix.ufl.element("Lagrange", mesh.basix_cell(), degree=1)
@@ -307,11 +160,9 @@ def discrete_atk(arg_N=2):
 
     # Boundary sets
 
-    locate_dofs_geometrical(V_alpha, lambda x: np.isclose(x[0], 0.0))
-    locate_dofs_geometrical(V_alpha, lambda x: np.isclose(x[0], Lx))
-
-    dofs_u_left = locate_dofs_geometrical(V_u, lambda x: np.isclose(x[0], 0.0))
-    dofs_u_right = locate_dofs_geometrical(V_u, lambda x: np.isclose(x[0], Lx))
+    _x_u = V_u.tabulate_dof_coordinates()[:, 0]
+    dofs_u_left = np.flatnonzero(np.isclose(_x_u, 0.0)).astype(np.int32)
+    dofs_u_right = np.flatnonzero(np.isclose(_x_u, Lx)).astype(np.int32)
 
     # Boundary data
 
@@ -345,13 +196,17 @@ def discrete_atk(arg_N=2):
 
     # mat_par = parameters.get()
 
+    # Material parameters, bound once for the constitutive functions below
+    _mu = parameters["model"]["mu"]
+    _k = parameters["model"]["k"]
+    _k_res = parameters["model"]["k_res"]
+    _w1 = parameters["model"]["w1"]
+    _ell = parameters["model"]["ell"]
+
     def a(alpha):
-        k_res = parameters["model"]["k_res"]
-        return (1 - alpha) ** 2 + k_res
+        return (1 - alpha) ** 2 + _k_res
 
     def a_atk(alpha):
-        parameters["model"]["k_res"]
-        _k = parameters["model"]["k"]
         return (1 - alpha) / ((_k - 1) * alpha + 1)
 
     def w(alpha):
@@ -367,10 +222,6 @@ def discrete_atk(arg_N=2):
         """
         Returns the elastic energy density from the state.
         """
-        # Parameters
-        _mu = parameters["model"]["mu"]
-        parameters["model"]["N"]
-
         alpha = state["alpha"]
         u = state["u"]
         eps = ufl.grad(u)
@@ -382,10 +233,6 @@ def discrete_atk(arg_N=2):
         """
         Return the damage dissipation density from the state.
         """
-        # Get the material parameters
-        parameters["model"]["mu"]
-        _w1 = parameters["model"]["w1"]
-        _ell = parameters["model"]["ell"]
         # Get the damage
         alpha = state["alpha"]
         # Compute the damage gradient
@@ -401,7 +248,7 @@ def discrete_atk(arg_N=2):
         u = state["u"]
         alpha = state["alpha"]
 
-        return parameters["model"]["mu"] * a_atk(alpha) * u.dx() * dx
+        return _mu * a_atk(alpha) * u.dx() * dx
 
     total_energy = (
         elastic_energy_density_atk(state) + damage_energy_density(state)
@@ -416,10 +263,8 @@ def discrete_atk(arg_N=2):
     load_par = parameters["loading"]
     loads = np.linspace(load_par["min"], load_par["max"], load_par["steps"])
 
-    _AlternateMinimisation(
-        total_energy, state, bcs, parameters.get("solvers"), bounds=(alpha_lb, alpha_ub)
-    )
-
+    # The state is set to the homogeneous solution at each load step,
+    # only the stability solvers are set up (once) and reused across steps
     stability = BifurcationSolver(
         total_energy, state, bcs, stability_parameters=parameters.get("stability")
     )
@@ -444,111 +289,146 @@ def discrete_atk(arg_N=2):
 
     check_stability = []
 
+    # Trajectories of the owned dofs, serialised once at the end of the run
+    alpha_t = np.empty((len(loads), state["alpha"].x.petsc_vec.getLocalSize()))
+    u_t = np.empty((len(loads), state["u"].x.petsc_vec.getLocalSize()))
+
+    # Forms evaluated at every load step, compiled once
+    fracture_energy_form = form(damage_energy_density(state) * dx)
+    elastic_energy_form = form(elastic_energy_density_atk(state) * dx)
+    stress_form = form(stress(state))
+
     def _critical_load(matpar):
         _mu, _k, _w1, _N = matpar["mu"], matpar["k"], matpar["w1"], matpar["N"]
         return np.sqrt(8 * _w1 / (_mu * _k) / 4)
 
-    def _homogeneous_state(state, t, matpar):
-        """docstring for _homogeneous_state"""
+    def _homogeneous_state(state, t, _k, _N, _tc):
+        """Set the state to the homogeneous solution at load t,
+        given the material parameter k, the number of springs N
+        and the critical load tc."""
 
         _u = state["u"]
         _alpha = state["alpha"]
-        _mu, _k, _w1, _N = matpar["mu"], matpar["k"], matpar["w1"], matpar["N"]
 
-        # _tc = np.sqrt(matpar/k)
         # _a = (tau - 1) / (_k - 1)
 
-        _tc = _critical_load(parameters["model"])
-
         if t <= _tc:
             # elastic
-            _alphah = [0.0 for i in range(0, _N)]
-            _uh = [i * t / _N for i in range(0, _N + 1)]
+            _α = 0.0
         else:
             # damaging
             _α = (t / _tc - 1) / (_k - 1)
-            _alphah = [_α for i in range(0, _N)]
-            _e = t / _N
-            _uh = [_e * i for i in range(0, _N + 1)]
 
-        _alpha.x.petsc_vec[:] = _alphah
-        _u.x.petsc_vec[:] = _uh
+        # homogeneous strain t/_N in every spring
+        fill_homogeneous(_u.x.array, _alpha.x.array, t, _α, _N)
 
-    for i_t, t in enumerate(loads):
-        logging.critical(f"-- Solving for t = {t:3.2f} --")
-        logging.basicConfig(level=logging.DEBUG)
-
-        # homogeneous solution
-        _homogeneous_state(state, t, parameters["model"])
-
-        # n_eigenvalues = 10
-        is_stable = stability.solve(alpha_lb)
-        is_elastic = stability.is_elastic()
-        inertia = stability.get_inertia()
-        # stability.save_eigenvectors(filename=f"{prefix}/{_nameExp}_eigv_{t:3.2f}.xdmf")
-        check_stability.append(is_stable)
-
-        ColorPrint.print_bold(f"State is elastic: {is_elastic}")
-        ColorPrint.print_bold(f"State's inertia: {inertia}")
-        ColorPrint.print_bold(f"State is stable: {is_stable}")
-
-        stable = cone.my_solve(alpha_lb)
-
-        # indptr, indices, data = cone.eigen.rA.getValuesCSR()
-        # _rA = scipy.sparse.csr_matrix((data, indices, indptr), shape=self.eigen.rA.sizes[0])
-        # fig_rA = plot_matrix(cone.eigen.rA)
-        # fig_rArB = plot_matrix(cone.eigen.rA, cone.eigen.rB, ms=10, names=["rA", "rB"])
-        # fig_rA.savefig(f"{prefix}/mat-rA-{cone.eigen.eps.getOptionsPrefix()}-{i_t}.png")
+        for f in [_u, _alpha]:
+            f.x.petsc_vec.ghostUpdate(
+                addv=PETSc.InsertMode.INSERT, mode=PETSc.ScatterMode.FORWARD
+            )
 
-        fig_A = plot_matrix(cone.eigen.A)
-        fig_A.savefig(f"{prefix}/mat-A-{cone.eigen.eps.getOptionsPrefix()}-{i_t}.png")
+    _tc = _critical_load(parameters["model"])
+    # Dump heatmaps of the stability operators at every load step (slow)
+    plot_matrices = parameters.get("output", {}).get("plot_matrices", False)
 
-        _fig = plot_matrix(cone.eigen.rA)
-        # __import__('pdb').set_trace()
-        _fig.savefig(f"{prefix}/mat-rA-{cone.eigen.eps.getOptionsPrefix()}-{i_t}.png")
+    # Trajectory of u and alpha (XDMF) and, on rank 0, the scalar history
+    # appended one line per load step (JSONL)
+    with XDMFFile(
+        comm, f"{prefix}/{_nameExp}.xdmf", "w", encoding=XDMFFile.Encoding.HDF5
+    ) as xdmf, (
+        open(f"{prefix}/time_data.jsonl", "w") if comm.rank == 0 else nullcontext()
+    ) as jsonl_file:
+        xdmf.write_mesh(mesh)
+
+        for i_t, t in enumerate(loads):
+            logging.critical(f"-- Solving for t = {t:3.2f} --")
+            logging.basicConfig(level=logging.DEBUG)
+
+            # homogeneous solution
+            _homogeneous_state(state, t, _k, _N, _tc)
+
+            # n_eigenvalues = 10
+            is_stable = stability.solve(alpha_lb)
+            is_elastic = stability.is_elastic()
+            inertia = stability.get_inertia()
+            # stability.save_eigenvectors(filename=f"{prefix}/{_nameExp}_eigv_{t:3.2f}.xdmf")
+            check_stability.append(is_stable)
+
+            ColorPrint.print_bold(f"State is elastic: {is_elastic}")
+            ColorPrint.print_bold(f"State's inertia: {inertia}")
+            ColorPrint.print_bold(f"State is stable: {is_stable}")
+
+            stable = cone.my_solve(alpha_lb)
+
+            # indptr, indices, data = cone.eigen.rA.getValuesCSR()
+            # _rA = scipy.sparse.csr_matrix((data, indices, indptr), shape=self.eigen.rA.sizes[0])
+            # fig_rA = plot_matrix(cone.eigen.rA)
+            # fig_rArB = plot_matrix(cone.eigen.rA, cone.eigen.rB, ms=10, names=["rA", "rB"])
+            # fig_rA.savefig(f"{prefix}/mat-rA-{cone.eigen.eps.getOptionsPrefix()}-{i_t}.png")
+
+            if plot_matrices:
+                _prefix = cone.eigen.eps.getOptionsPrefix()
+                fig_A = plot_matrix(cone.eigen.A)
+                fig_A.savefig(f"{prefix}/mat-A-{_prefix}-{i_t}.png")
+                plt.close(fig_A)
+
+                _fig = plot_matrix(cone.eigen.rA)
+                _fig.savefig(f"{prefix}/mat-rA-{_prefix}-{i_t}.png")
+                plt.close(_fig)
+
+            _local = np.array(
+                [
+                    assemble_scalar(fracture_energy_form),
+                    assemble_scalar(elastic_energy_form),
+                    assemble_scalar(stress_form),
+                ],
+                dtype=np.float64,
+            )
+            _global = np.empty_like(_local)
+            comm.Allreduce(_local, _global, op=MPI.SUM)
+            fracture_energy, elastic_energy, _F = _global
+
+            step_data = {
+                "load": t,
+                "elastic_energy": elastic_energy,
+                "fracture_energy": fracture_energy,
+                "total_energy": elastic_energy + fracture_energy,
+                # "solver_data": solver.data,
+                "cone_data": cone.data,
+                "eigs": stability.data["eigs"],
+                "cone-stable": stable,
+                "non-bifurcation": not stability.data["stable"],
+                "F": _F,
+            }
+            for key, value in step_data.items():
+                history_data[key].append(value)
+
+            if comm.rank == 0:
+                jsonl_file.write(json.dumps(step_data) + "\n")
+                jsonl_file.flush()
+
+            alpha_t[i_t] = state["alpha"].x.petsc_vec.array_r
+            u_t[i_t] = state["u"].x.petsc_vec.array_r
+
+            logging.critical(f"u_t {u.x.petsc_vec.array}")
+            logging.critical(f"u_t norm {state['u'].x.petsc_vec.norm()}")
+
+            xdmf.write_function(u, t)
+            xdmf.write_function(alpha, t)
+
+    history_data["alpha_t"] = alpha_t.tolist()
+    history_data["u_t"] = u_t.tolist()
 
-        fracture_energy = comm.allreduce(
-            assemble_scalar(form(damage_energy_density(state) * dx)),
-            op=MPI.SUM,
-        )
-        elastic_energy = comm.allreduce(
-            assemble_scalar(form(elastic_energy_density_atk(state) * dx)),
-            op=MPI.SUM,
-        )
-        _F = assemble_scalar(form(stress(state)))
-
-        history_data["load"].append(t)
-        history_data["fracture_energy"].append(fracture_energy)
-        history_data["elastic_energy"].append(elastic_energy)
-        history_data["total_energy"].append(elastic_energy + fracture_energy)
-        # history_data["solver_data"].append(solver.data)
-        history_data["cone_data"].append(cone.data)
-        history_data["eigs"].append(stability.data["eigs"])
-        history_data["non-bifurcation"].append(not stability.data["stable"])
-        history_data["cone-stable"].append(stable)
-        history_data["F"].append(_F)
-        history_data["alpha_t"].append(state["alpha"].x.petsc_vec.array.tolist())
-        history_data["u_t"].append(state["u"].x.petsc_vec.array.tolist())
-
-        logging.critical(f"u_t {u.x.petsc_vec.array}")
-        logging.critical(f"u_t norm {state['u'].x.petsc_vec.norm()}")
-
-        with XDMFFile(
-            comm, f"{prefix}/{_nameExp}.xdmf", "a", encoding=XDMFFile.Encoding.HDF5
-        ) as file:
-            file.write_function(u, t)
-            file.write_function(alpha, t)
-
-        if comm.rank == 0:
-            a_file = open(f"{prefix}/time_data.json", "w")
+    if comm.rank == 0:
+        with open(f"{prefix}/time_data.json", "w") as a_file:
             json.dump(history_data, a_file)
-            a_file.close()
 
     list_timings(MPI.COMM_WORLD, [dolfinx.common.TimingType.wall])
     # print(history_data)
 
-    df = pd.DataFrame(history_data)
-    print(df)
+    if comm.rank == 0:
+        df = pd.read_json(f"{prefix}/time_data.jsonl", lines=True)
+        print(df)
 
     return history_data, prefix, _nameExp
 
@@ -0,0 +1,48 @@
+import numpy as np
+
+# Below this number of springs the NumPy fill is cheaper than starting
+# numba's thread pool and paying the JIT compile on the first call
+NUMBA_MIN_SIZE = 100_000
+
+
+def _fill_homogeneous_numpy(u_arr, alpha_arr, t, alpha_h, N):
+    """Write the homogeneous state of N springs under load t into the arrays"""
+    u_arr[: N + 1] = np.arange(N + 1) * (t / N)
+    alpha_arr[:N] = alpha_h
+
+
+try:
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def _fill_homogeneous_numba(u_arr, alpha_arr, t, alpha_h, N):
+        """Write the homogeneous state of N springs under load t into the arrays"""
+        _e = t / N
+        for i in numba.prange(N + 1):
+            u_arr[i] = _e * i
+        for i in numba.prange(N):
+            alpha_arr[i] = alpha_h
+
+except ImportError:
+    _fill_homogeneous_numba = None
+
+
+def fill_homogeneous(u_arr, alpha_arr, t, alpha_h, N):
+    """
+    Write the homogeneous state of N springs in series under load t:
+    displacements i * t / N at the N + 1 nodes and damage alpha_h in
+    the N springs.
+
+    The arrays must hold all the dofs of the chain, which is the case
+    on a single process only.
+    """
+    if u_arr.shape[0] < N + 1 or alpha_arr.shape[0] < N:
+        raise ValueError(
+            f"Local arrays of sizes {u_arr.shape[0]}, {alpha_arr.shape[0]} "
+            f"cannot hold the homogeneous state of {N} springs"
+        )
+
+    if _fill_homogeneous_numba is not None and N >= NUMBA_MIN_SIZE:
+        _fill_homogeneous_numba(u_arr, alpha_arr, t, alpha_h, N)
+    else:
+        _fill_homogeneous_numpy(u_arr, alpha_arr, t, alpha_h, N)
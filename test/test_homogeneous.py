@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from irrevolutions.utils.homogeneous import (_fill_homogeneous_numba,
+                                             _fill_homogeneous_numpy,
+                                             fill_homogeneous)
+
+
+@pytest.mark.parametrize("N", [1, 2, 17])
+def test_fill_homogeneous(N):
+    t, alpha_h = 1.5, 0.25
+    u, alpha = np.zeros(N + 1), np.zeros(N)
+    fill_homogeneous(u, alpha, t, alpha_h, N)
+
+    assert np.allclose(u, [i * t / N for i in range(N + 1)])
+    assert np.allclose(alpha, alpha_h)
+
+
+@pytest.mark.parametrize("N", [1, 2, 17, 1000])
+@pytest.mark.parametrize("t, alpha_h", [(0.5, 0.0), (3.0, 0.4)])
+def test_fill_homogeneous_numba_vs_numpy(N, t, alpha_h):
+    if _fill_homogeneous_numba is None:
+        pytest.skip("numba is not available")
+
+    u_ref, alpha_ref = np.zeros(N + 1), np.zeros(N)
+    _fill_homogeneous_numpy(u_ref, alpha_ref, t, alpha_h, N)
+
+    u, alpha = np.zeros(N + 1), np.zeros(N)
+    _fill_homogeneous_numba(u, alpha, t, alpha_h, N)
+
+    assert np.allclose(u, u_ref)
+    assert np.allclose(alpha, alpha_ref)
+    assert np.isclose(u[-1], t)
+
+
+def test_fill_homogeneous_size_mismatch():
+    N = 10
+    with pytest.raises(ValueError):
+        fill_homogeneous(np.zeros(N), np.zeros(N), 1.0, 0.0, N)
+    with pytest.raises(ValueError):
+        fill_homogeneous(np.zeros(N + 1), np.zeros(N - 1), 1.0, 0.0, N)